@@ -4,7 +4,7 @@ decode output of yolo model
 """
 import torch
 import numpy as np
-from utils import nms, whToxy
+from utils import nms, batched_nms, whToxy
 
 """
 anchors: numpy array of (W, H)
@@ -79,7 +79,8 @@ def filter(
     num_cls=80,
     threshold=0.6,
     iou_threshold=0.5,
-    max_output_size=None
+    max_output_size=None,
+    per_class=False
 ):
     anchor_mask = np.array([[6, 7, 8], [3, 4, 5], [0, 1, 2]])
     outputs = full_decode(feats, anchors, anchor_mask, device, num_cls)
@@ -113,33 +114,23 @@ def filter(
 
     """
     step 2: non max suppression
+    per_class: suppress boxes only against boxes of the same class
     """
-    selected_indices = nms(boxes, scores, device)
-    boxes_ = boxes[selected_indices]
-    scores_ = scores[selected_indices]
-    classes_ = classes[selected_indices]
-    """
-
-    # nms by each classes
-    boxes_ = []
-    scores_ = []
-    classes_ = []
-    unique_classes = classes.unique()
-    for c in unique_classes:
-        cls_mask = (classes == c)
-        selected_indices = nms(
-            boxes[cls_mask],
-            scores[cls_mask],
+    if per_class:
+        selected_indices = batched_nms(
+            boxes,
+            scores,
+            classes,
             device,
             iou_threshold,
             max_output_size
         )
-        boxes_.append(boxes[selected_indices])
-        scores_.append(scores[selected_indices])
-        classes_.append(classes[selected_indices])
-    boxes_ = torch.cat(boxes_, dim=0)
-    scores_ = torch.cat(scores_, dim=0)
-    classes_ = torch.cat(classes_, dim=0)
-    """
+    else:
+        selected_indices = nms(
+            boxes, scores, device, iou_threshold, max_output_size
+        )
+    boxes_ = boxes[selected_indices]
+    scores_ = scores[selected_indices]
+    classes_ = classes[selected_indices]
 
     return boxes_, scores_, classes_
\ No newline at end of file
@@ -0,0 +1,160 @@
+/*
+Non max suppression on CUDA
+Boxes are sorted by score, then
+step 1: every block compares 64 row boxes against 64 column boxes and packs
+        the overlaps of one row box into a 64-bit mask, upper triangle only
+step 2: a single block walks the boxes in score order and unwraps the masks
+        in shared memory, so the mask never goes back to the host
+Loaded with torch.utils.cpp_extension.load, see utils.nms
+*/
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAGuard.h>
+
+constexpr int kThreadsPerBlock = 64; // bits of unsigned long long
+constexpr int kUnwrapThreads = 256;
+
+__device__ inline float box_area(const float* a) {
+    return (a[2] - a[0]) * (a[3] - a[1]);
+}
+
+/* iou > threshold, compared as inter > threshold * union to avoid division */
+__device__ inline bool overlaps(
+    const float* a, const float area_a, const float* b, const float area_b, const float threshold
+) {
+    float left = fmaxf(a[0], b[0]);
+    float top = fmaxf(a[1], b[1]);
+    float right = fminf(a[2], b[2]);
+    float bottom = fminf(a[3], b[3]);
+    float inter = fmaxf(right - left, 0.f) * fmaxf(bottom - top, 0.f);
+    return inter > threshold * (area_a + area_b - inter);
+}
+
+__global__ void nms_mask_kernel(
+    const int n,
+    const float threshold,
+    const float* boxes,
+    unsigned long long* mask
+) {
+    const int row_start = blockIdx.y;
+    const int col_start = blockIdx.x;
+    // a box is only suppressed by boxes with higher scores
+    if (row_start > col_start) return;
+
+    const int col_blocks = gridDim.x;
+    const int row_size = min(n - row_start * kThreadsPerBlock, kThreadsPerBlock);
+    const int col_size = min(n - col_start * kThreadsPerBlock, kThreadsPerBlock);
+
+    // areas are computed once per box, not once per compared pair
+    __shared__ float block_boxes[kThreadsPerBlock * 4];
+    __shared__ float block_areas[kThreadsPerBlock];
+    if (threadIdx.x < col_size) {
+        const int col = col_start * kThreadsPerBlock + threadIdx.x;
+        for (int k = 0; k < 4; k++) {
+            block_boxes[threadIdx.x * 4 + k] = boxes[col * 4 + k];
+        }
+        block_areas[threadIdx.x] = box_area(boxes + col * 4);
+    }
+    __syncthreads();
+
+    if (threadIdx.x < row_size) {
+        const int row = row_start * kThreadsPerBlock + threadIdx.x;
+        const float* row_box = boxes + row * 4;
+        const float row_area = box_area(row_box);
+        unsigned long long bits = 0;
+        const int start = (row_start == col_start) ? threadIdx.x + 1 : 0;
+        for (int i = start; i < col_size; i++) {
+            if (overlaps(row_box, row_area, block_boxes + i * 4, block_areas[i], threshold)) {
+                bits |= 1ULL << i;
+            }
+        }
+        mask[static_cast<int64_t>(row) * col_blocks + col_start] = bits;
+    }
+}
+
+__global__ void nms_unwrap_kernel(
+    const int n,
+    const int col_blocks,
+    const unsigned long long* mask,
+    int64_t* keep,
+    int64_t* num_keep
+) {
+    extern __shared__ unsigned long long removed[];
+    for (int j = threadIdx.x; j < col_blocks; j += blockDim.x) {
+        removed[j] = 0;
+    }
+    __syncthreads();
+
+    int count = 0;
+    for (int i = 0; i < n; i++) {
+        const int nblock = i / kThreadsPerBlock;
+        const int inblock = i % kThreadsPerBlock;
+        const bool kept = !(removed[nblock] & (1ULL << inblock));
+        __syncthreads();
+        if (kept) {
+            if (threadIdx.x == 0) keep[count] = i;
+            count++;
+            // only the upper triangle of the mask is written
+            const unsigned long long* row_mask = mask + static_cast<int64_t>(i) * col_blocks;
+            for (int j = nblock + threadIdx.x; j < col_blocks; j += blockDim.x) {
+                removed[j] |= row_mask[j];
+            }
+        }
+        __syncthreads();
+    }
+    if (threadIdx.x == 0) *num_keep = count;
+}
+
+/*
+boxes: [N, 4], coord format (x1, y1, x2, y2)
+scores: [N,]
+returns indices of kept boxes sorted by decreasing score
+*/
+at::Tensor nms(const at::Tensor& boxes, const at::Tensor& scores, double iou_threshold) {
+    TORCH_CHECK(boxes.is_cuda(), "boxes must be a CUDA tensor");
+    TORCH_CHECK(scores.is_cuda(), "scores must be a CUDA tensor");
+    TORCH_CHECK(boxes.dim() == 2 && boxes.size(1) == 4, "boxes must be of shape [N, 4]");
+    TORCH_CHECK(boxes.size(0) == scores.size(0), "boxes and scores must have the same length");
+    at::cuda::CUDAGuard device_guard(boxes.device());
+
+    const int n = boxes.size(0);
+    if (n == 0) {
+        return at::empty({0}, boxes.options().dtype(at::kLong));
+    }
+
+    const auto order = std::get<1>(scores.sort(0, /*descending=*/true));
+    const auto boxes_sorted = boxes.index_select(0, order).to(at::kFloat).contiguous();
+
+    const int col_blocks = (n + kThreadsPerBlock - 1) / kThreadsPerBlock;
+    TORCH_CHECK(
+        col_blocks * sizeof(unsigned long long) <= 48 * 1024,
+        "too many boxes for nms_cuda: ", n
+    );
+    auto mask = at::empty({n, col_blocks}, boxes.options().dtype(at::kLong));
+    auto keep = at::empty({n}, boxes.options().dtype(at::kLong));
+    auto num_keep = at::empty({1}, boxes.options().dtype(at::kLong));
+
+    cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+    const dim3 blocks(col_blocks, col_blocks);
+    nms_mask_kernel<<<blocks, kThreadsPerBlock, 0, stream>>>(
+        n,
+        static_cast<float>(iou_threshold),
+        boxes_sorted.data_ptr<float>(),
+        reinterpret_cast<unsigned long long*>(mask.data_ptr<int64_t>())
+    );
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+    nms_unwrap_kernel<<<1, kUnwrapThreads, col_blocks * sizeof(unsigned long long), stream>>>(
+        n,
+        col_blocks,
+        reinterpret_cast<const unsigned long long*>(mask.data_ptr<int64_t>()),
+        keep.data_ptr<int64_t>(),
+        num_keep.data_ptr<int64_t>()
+    );
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+
+    return order.index_select(0, keep.narrow(0, 0, num_keep.item<int64_t>()));
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("nms", &nms, "non max suppression (CUDA)");
+}
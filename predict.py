@@ -7,8 +7,8 @@ from decode import filter
 """params"""
 image_path  = './data/car.jpg'
 input_shape = (416, 416)
-im, image, image_size = utils.preprocess_image(image_path, input_shape)
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+im, image, image_size = utils.preprocess_image(image_path, input_shape, device)
 
 anchors = np.array([
     [10, 13], [16, 30], [33, 23], [30, 61], [62, 45], 
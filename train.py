@@ -23,6 +23,9 @@ def create_fake_data(image_shape, num_classes=80, num_of_batch=10):
         yield imgs, tars
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# allow TF32 tensor cores for matmul and conv on Ampere and later GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 """params"""
 # anchors as unit of pixel
@@ -1,10 +1,13 @@
+import os
 import numpy as np
 import torch
+import torchvision
 import warnings
 from PIL import Image, ImageDraw, ImageFont
-import torchvision.transforms as transforms
 import colorsys
+import functools
 import random
+from pathlib import Path
 
 """
 Transform (x, y, w, h) into (x1, y1, x2, y2)
@@ -24,39 +27,50 @@ def whToxy(box, reversed=False):
     return box_
 
 """
-calculate iou of two boxes
+calculate iou of two boxes elementwise
 box1: (x1, y1, x2, y2)
 box2: (x1, y1, x2, y2)
+box1 and box2 are broadcast against each other, e.g. [N, 4] and [N, 4]
+give [N,] ious of matching pairs, use pairwise_iou for all pairs
 """
 def iou(box1, box2):
-    box1_x1, box1_y1, box1_x2, box1_y2 = box1[...,0], box1[...,1], box1[...,2], box1[...,3]
-    box2_x1, box2_y1, box2_x2, box2_y2 = box2[...,0], box2[...,1], box2[...,2], box2[...,3]
-
-    x1 = torch.max(box1_x1, box2_x1)
-    y1 = torch.max(box1_y1, box2_y1)
-    x2 = torch.min(box1_x2, box2_x2)
-    y2 = torch.min(box1_y2, box2_y2) 
-
-    ins_area = (x2 - x1).clamp(min=0) * (y2 - y1).clamp(min=0)
-    uni_area = (
-        (box1_x1 - box1_x2) * (box1_y1 - box1_y2) + 
-        (box2_x1 - box2_x2) * (box2_y1 - box2_y2)
-        - ins_area
-    )
+    ins_w = (
+        torch.min(box1[..., 2], box2[..., 2]) - torch.max(box1[..., 0], box2[..., 0])
+    ).clamp_(min=0)
+    ins_h = (
+        torch.min(box1[..., 3], box2[..., 3]) - torch.max(box1[..., 1], box2[..., 1])
+    ).clamp_(min=0)
+    ins_area = ins_w * ins_h
 
-    iou_scores = ins_area / uni_area
+    area1 = (box1[..., 2] - box1[..., 0]) * (box1[..., 3] - box1[..., 1])
+    area2 = (box2[..., 2] - box2[..., 0]) * (box2[..., 3] - box2[..., 1])
+    iou_scores = ins_area / (area1 + area2 - ins_area + 1e-7)
     return iou_scores
 
+"""
+calculate iou of all pairs of boxes
+box1: shape->[N, 4], corrd format(x1, y1, x2, y2)
+box2: shape->[M, 4], corrd format(x1, y1, x2, y2)
+return: iou_scores-> shape [N, M]
+"""
+def pairwise_iou(box1, box2):
+    return torchvision.ops.box_iou(box1, box2)
+
 """
 Read the classes names
 """
 def get_classes(file_path):
-    classes = []
-    with open(file_path, 'r')  as f:
-        for line in f.readlines():
-            line = line.rstrip()
-            classes.append(line)
-    return classes
+    return Path(file_path).read_text().splitlines()
+
+"""
+Copy a host tensor to device
+For cuda the copy is issued from pinned memory w/o making the host wait
+on the stream, ops queued after it on the same stream see the copied data
+"""
+def _to_device(tensor, device):
+    if tensor.device.type == 'cpu' and torch.device(device).type == 'cuda':
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
 
 """
 Find detector in YOLO where ground truth box should appear.
@@ -71,6 +85,8 @@ anchors : array
 Returns
 -------
 matching_true_boxes: tensor, [B, H, W, A, num_cls + 5]
+    If several boxes match the same cell and anchor, the coordinates of
+    the last one are kept and the class flags of all of them are set.
 -----------
 Ref: https://github.com/allanzelener/YAD2K
 """
@@ -78,37 +94,66 @@ def preprocess_true_boxes(labels, anchors, grid_size, device, num_cls=80):
     W, H = grid_size
     A = len(anchors)
     B = len(labels) 
-    matching_true_boxes = np.zeros((B, H, W, A, 5+num_cls), dtype=np.float32)
-    labels_ = labels.copy()
-    labels_[..., 0:2] = labels_[..., 0:2] * np.array([H, W]).reshape(1, 2)
-    for b in range(B):
-        for box in labels_[b]:
-            i = int(box[0])
-            j = int(box[1])
-            box_wh = box[2:4].reshape(1, 2)
-            min_wh = np.minimum(box_wh, anchors)
-            ins_area = min_wh[..., 0] * min_wh[..., 1]
-            uni_area = (
-                box_wh[..., 0] * box_wh[..., 1] 
-                + anchors[..., 0] * anchors[..., 1]
-                - ins_area
-            )
-            iou_scores = ins_area / (uni_area + 1e-8)
-            idx = np.argmax(iou_scores, axis=-1)
-
-            matching_true_boxes[b, i, j, idx, 0] = box[0] / H
-            matching_true_boxes[b, i, j, idx, 1] = box[1] / W
-            matching_true_boxes[b, i, j, idx, 2] = box[2]
-            matching_true_boxes[b, i, j, idx, 3] = box[3]
-            matching_true_boxes[b, i, j, idx, 4] = 1
-            assert len(box) >= 4
-            # for multi-label
-            for k in box[4:]:
-                matching_true_boxes[b, i, j, idx, int(k)+5] = 1
-
-    matching_true_boxes = torch.from_numpy(matching_true_boxes).to(device)
+    matching_true_boxes = torch.zeros(
+        (B, H, W, A, 5+num_cls), dtype=torch.float32, device=device
+    )
+    assert labels.shape[-1] >= 4
+    labels_ = torch.as_tensor(labels)
+    anchors_ = torch.as_tensor(anchors, dtype=labels_.dtype)
+    labels_ = _to_device(labels_, device)
+    anchors_ = _to_device(anchors_, device)
+    # flatten to [B*num_of_boxes, 5+] and keep track of batch index
+    boxes = labels_.reshape(-1, labels_.shape[-1])
+    b = torch.arange(B, device=device).repeat_interleave(labels_.shape[1])
+    i = (boxes[:, 0] * H).long()
+    j = (boxes[:, 1] * W).long()
+
+    # best anchor of each box w/ respect to iou of (w, h)
+    # only [num_of_boxes, A] temporaries, no [num_of_boxes, A, 2]
+    box_w, box_h = boxes[:, 2:3], boxes[:, 3:4]
+    ins_area = torch.minimum(box_w, anchors_[:, 0]) * torch.minimum(box_h, anchors_[:, 1])
+    uni_area = box_w * box_h + anchors_[:, 0] * anchors_[:, 1] - ins_area
+    iou_scores = ins_area / (uni_area + 1e-8)
+    idx = torch.argmax(iou_scores, dim=-1)
+
+    # scatter order of duplicated indices is undefined, so every box
+    # writes the coords of the last box matching the same cell and anchor
+    flat_idx = ((b * H + i) * W + j) * A + idx
+    order = torch.arange(len(flat_idx), device=device)
+    last = torch.full((B * H * W * A,), -1, dtype=torch.long, device=device)
+    last = last.scatter_reduce_(0, flat_idx, order, reduce='amax')
+    matching_true_boxes[b, i, j, idx, 0:4] = boxes[last[flat_idx], 0:4].float()
+    matching_true_boxes[b, i, j, idx, 4] = 1
+    # for multi-label
+    cls_idx = boxes[:, 4:].long() + 5
+    matching_true_boxes[b[:, None], i[:, None], j[:, None], idx[:, None], cls_idx] = 1
+
     return matching_true_boxes
 
+"""
+Build the CUDA nms kernel in nms_cuda.cu on first use
+Returns None if it can not be built, then torchvision nms is used instead
+"""
+_nms_cuda = None
+def _load_nms_cuda():
+    global _nms_cuda
+    if _nms_cuda is None:
+        try:
+            from torch.utils.cpp_extension import load
+            source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nms_cuda.cu')
+            _nms_cuda = load(name='nms_cuda', sources=[source])
+        except Exception as e:
+            warnings.warn("Failed to build nms_cuda, use torchvision nms: {}".format(e))
+            _nms_cuda = False
+    return _nms_cuda or None
+
+def _nms(boxes, scores, iou_threshold):
+    if boxes.is_cuda:
+        nms_cuda = _load_nms_cuda()
+        if nms_cuda is not None:
+            return nms_cuda.nms(boxes, scores, iou_threshold)
+    return torchvision.ops.nms(boxes, scores, iou_threshold)
+
 """
 Non max suppression to filter predicted boxes
 Inputs:
@@ -118,6 +163,8 @@ scores: tensor
         shape->[N,]
 max_output_size: int
         max number of boxes to be selected by nms
+        nms runs on the top 4 * max_output_size scores first, and on all
+        boxes only if those do not give max_output_size boxes
 iou_threshold: float
         the threshold deciding whether boxes overlaps too much w/ respect to iou
 Returns:
@@ -128,59 +175,138 @@ def nms(boxes, scores, device, iou_threshold=0.5, max_output_size=None):
     assert len(boxes) == len(scores)
     if len(scores) == 0:
         warnings.warn("No boxes need to be filtered by nms")
-        return torch.LongTensor([]).to(device)
-
-    x1 = boxes[..., 0]
-    y1 = boxes[..., 1]
-    x2 = boxes[..., 2]
-    y2 = boxes[..., 3]
-    area = (x2 - x1) * (y2- y1) # shape [N,]
-    assert (area > 0).all()
-    _, indices = torch.sort(scores, descending=True)
-    selected_indices = []
-    flag = 0 # to track num of output
-    if max_output_size is None:
-        max_output_size = len(scores) + 1
-
-    while indices.numel() > 0:
-        idx = indices[0]
-        flag += 1
-        remain_idx = indices[1:]
-        selected_indices.append(idx.item())
-        # make sure no empty tensor in remain_idx
-        if remain_idx.numel() == 0:
-            break
+        return torch.empty(0, dtype=torch.long, device=device)
 
-        x1_ = torch.max(x1[remain_idx], x1[idx])
-        y1_ = torch.max(y1[remain_idx], y1[idx])
-        x2_ = torch.min(x2[remain_idx], x2[idx])
-        y2_ = torch.min(y2[remain_idx], y2[idx])
-        ins = (x2_ - x1_).clamp(min=0) * (y2_ - y1_).clamp(min=0)
-        iou = ins / (area[idx] + area[remain_idx] - ins)
-        keep_mask = iou < iou_threshold
-        indices = remain_idx[keep_mask]
+    selected_indices = None
+    if max_output_size is not None and len(scores) > 4 * max_output_size:
+        # greedy nms on the top scores keeps the same boxes as on all boxes,
+        # so it is enough when it already gives max_output_size boxes
+        _, candidates = torch.topk(scores, 4 * max_output_size)
+        selected_indices = candidates[
+            _nms(boxes[candidates], scores[candidates], iou_threshold)
+        ]
+        if len(selected_indices) < max_output_size:
+            selected_indices = None
+    if selected_indices is None:
+        selected_indices = _nms(boxes, scores, iou_threshold)
+    if max_output_size is not None:
+        selected_indices = selected_indices[:max_output_size]
+    return selected_indices.to(device)
 
-        if torch.sum(keep_mask) == 0:
+"""
+Non max suppression performed independently for each class
+Boxes are offset by class index * (max coord + 1), so that boxes
+of different classes never overlap, and one nms call covers all classes
+Inputs:
+idxs: tensor
+        shape->[N,], class index of each box
+other params are the same as nms
+Returns:
+selected_indices: LongTensor
+        shape->[M,], M <= N
+"""
+def batched_nms(boxes, scores, idxs, device, iou_threshold=0.5, max_output_size=None):
+    assert len(boxes) == len(idxs)
+    if boxes.numel() == 0:
+        return nms(boxes, scores, device, iou_threshold, max_output_size)
+
+    offsets = idxs.to(boxes) * (boxes.max() + 1)
+    boxes_for_nms = boxes + offsets[:, None]
+    return nms(boxes_for_nms, scores, device, iou_threshold, max_output_size)
+
+"""
+Gaussian soft non max suppression
+Instead of dropping overlapped boxes, their scores are decayed by
+exp(-iou^2 / sigma) w/ respect to each selected box
+Inputs:
+boxes: tensor
+        shape->[N, 4], corrd format(x1, y1, x2, y2)
+scores: tensor
+        shape->[N,]
+sigma: float
+        the larger sigma, the less overlapped boxes are decayed
+score_threshold: float
+        stop once the best remaining decayed score is lower than it
+max_output_size: int
+        max number of boxes to be selected by nms
+Returns:
+selected_indices: LongTensor
+        shape->[M,], M <= N
+selected_scores: tensor
+        shape->[M,], decayed scores of selected boxes
+"""
+def soft_nms(boxes, scores, device, sigma=0.5, score_threshold=1e-3, max_output_size=None):
+    assert len(boxes) == len(scores)
+    selected_indices = torch.empty(0, dtype=torch.long, device=scores.device)
+    if len(scores) == 0:
+        warnings.warn("No boxes need to be filtered by nms")
+        return selected_indices.to(device), scores.to(device)
+    if max_output_size is None:
+        max_output_size = len(scores)
+
+    scores = scores.clone()
+    remain_mask = torch.ones_like(scores, dtype=torch.bool)
+    selected = []
+    for _ in range(min(max_output_size, len(scores))):
+        idx = torch.argmax(scores.masked_fill(~remain_mask, -1))
+        if scores[idx] < score_threshold:
             break
-        if flag >= max_output_size:
-            break 
-    
-    return torch.LongTensor(selected_indices).to(device)
+        selected.append(idx)
+        remain_mask[idx] = False
+        decay = torch.exp(-iou(boxes[idx], boxes) ** 2 / sigma)
+        scores = torch.where(remain_mask, scores * decay, scores)
+
+    if len(selected) > 0:
+        selected_indices = torch.stack(selected)
+    return selected_indices.to(device), scores[selected_indices].to(device)
 
+"""
+Read image size from the file header without decoding pixels
+Use it instead of preprocess_image when only the size is needed,
+e.g. to rescale labels of a whole dataset
+return: image_size-> (width, height)
+"""
+def get_image_size(image_path):
+    with Image.open(image_path) as im:
+        return im.size
 
 """
 Preprocess input image to match Model input shape
 And add batch dimension
 Default Model Input shape is (416, 416)
+When device is cuda, the full resolution uint8 pixels are uploaded and
+converted to float on the GPU, then resized and rescaled there;
+otherwise PIL resizes on the CPU before the float conversion
 return: image-> tensor, channel-first
         image_size-> (width, height)
         im-> PIL format
 """
-def preprocess_image(image_path, input_shape=(416, 416)):
+def preprocess_image(image_path, input_shape=(416, 416), device=None):
     im = Image.open(image_path)
     image_size = im.size
-    im_ = im.resize(input_shape)
-    image = transforms.ToTensor()(im_)
+    # L, P, RGBA, ... images would not give 3 channels
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    if device is not None and torch.device(device).type == 'cuda':
+        W, H = input_shape
+        image = torch.from_numpy(np.array(im, dtype=np.uint8)).to(device)
+        image = torch.nn.functional.interpolate(
+            image.permute(2, 0, 1).unsqueeze(0).float(),
+            size=(H, W),
+            mode='bilinear',
+            align_corners=False,
+            antialias=True
+        )
+        image = image.div_(255)[0]
+    else:
+        im_ = im.resize(input_shape, Image.BILINEAR)
+        image = (
+            torch.from_numpy(np.array(im_, dtype=np.uint8))
+            .permute(2, 0, 1)
+            .contiguous()
+            .float()
+            .div_(255)
+        )
     c, h, w = image.shape
     image = image.view(1, c, h, w)
     return im, image, image_size
@@ -190,37 +316,44 @@ Following Code to draw boxes are from github repo:
 https://github.com/allanzelener/YAD2K
 """
 
-def generate_colors(class_names):
-    hsv_tuples = [(x / len(class_names), 1., 1.) for x in range(len(class_names))]
+# palette only depends on the number of classes, so build it once
+@functools.lru_cache(maxsize=None)
+def _generate_colors(num_classes):
+    hsv_tuples = [(x / num_classes, 1., 1.) for x in range(num_classes)]
     colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
     colors = list(map(
         lambda x: (int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)), colors))
     random.seed(10101)  # Fixed seed for consistent colors across runs.
     random.shuffle(colors)  # Shuffle colors to decorrelate adjacent classes.
     random.seed(None)  # Reset seed to default.
-    return colors
+    return tuple(colors)
+
+def generate_colors(class_names):
+    return list(_generate_colors(len(class_names)))
 
 def draw_boxes(image, out_scores, out_boxes, out_classes, class_names, colors):
     
     font = ImageFont.truetype(
         font='data/FiraMono-Medium.otf',size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
     thickness = (image.size[0] + image.size[1]) // 300
+    draw = ImageDraw.Draw(image)
+
+    # round and clip all boxes at once, (top, left, bottom, right)
+    boxes = np.floor(np.asarray(out_boxes).reshape(-1, 4) + 0.5).astype('int32')
+    boxes[:, 0:2] = np.maximum(boxes[:, 0:2], 0)
+    boxes[:, 2] = np.minimum(boxes[:, 2], image.size[1])
+    boxes[:, 3] = np.minimum(boxes[:, 3], image.size[0])
+    boxes = boxes.tolist()
 
     for i, c in reversed(list(enumerate(out_classes))):
         predicted_class = class_names[c]
-        box = out_boxes[i]
         score = out_scores[i]
 
         label = '{} {:.2f}'.format(predicted_class, score)
 
-        draw = ImageDraw.Draw(image)
         label_size = draw.textsize(label, font)
 
-        top, left, bottom, right = box
-        top = max(0, np.floor(top + 0.5).astype('int32'))
-        left = max(0, np.floor(left + 0.5).astype('int32'))
-        bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-        right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
+        top, left, bottom, right = boxes[i]
 
         if top - label_size[1] >= 0:
             text_origin = np.array([left, top - label_size[1]])
@@ -228,8 +361,7 @@ def draw_boxes(image, out_scores, out_boxes, out_classes, class_names, colors):
             text_origin = np.array([left, top + 1])
 
         # My kingdom for a good redistributable image drawing library.
-        for i in range(thickness):
-            draw.rectangle([left + i, top + i, right - i, bottom - i], outline=colors[c])
+        draw.rectangle([left, top, right, bottom], outline=colors[c], width=thickness)
         draw.rectangle([tuple(text_origin), tuple(text_origin + label_size)], fill=colors[c])
         draw.text(text_origin, label, fill=(0, 0, 0), font=font)
-        del draw
\ No newline at end of file
+    del draw
\ No newline at end of file